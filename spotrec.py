@@ -2,13 +2,12 @@
 
 # License: https://raw.githubusercontent.com/Bleuzen/SpotRec/master/LICENSE
 
-import dbus
-from dbus.exceptions import DBusException
-import dbus.mainloop.glib
-from gi.repository import GLib
 from pathlib import Path
 
-from threading import Thread
+from threading import Thread, Lock
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+import threading
 import subprocess
 import time
 import sys
@@ -19,7 +18,10 @@ import argparse
 import traceback
 import logging
 import shlex
-import requests
+import json
+
+# Optional / heavy modules are imported on first use to keep the startup fast:
+# 'dbus' and 'gi' in Spotify(), 'requests' in FFmpeg.add_cover_art()
 
 # Deps:
 # 'python'
@@ -45,6 +47,8 @@ _filename_pattern = "{trackNumber} - {artist} - {title}"
 _underscored_filenames = False
 _use_internal_track_counter = False
 _add_cover_art = False
+_gapless = False
+_collision_policy = "overwrite"
 
 # Hard-coded settings
 _pa_recording_sink_name = "spotrec"
@@ -57,23 +61,40 @@ _recording_minimum_time = 8.0 # this should be longer than _playback_time_before
 _shell_executable = "/bin/bash"  # Default: "/bin/sh"
 _shell_encoding = "utf-8"
 _ffmpeg_executable = "ffmpeg"  # Example: "/usr/bin/ffmpeg"
+_ffprobe_executable = "ffprobe"  # Example: "/usr/bin/ffprobe"
+_journal_filename = ".spotrec-journal"  # stored in the output directory
+_journal_compact_entries = 1000  # rewrite the journal with only the pending entries after this many writes
+_recovery_workers = 4
+_recovery_tail_allowance = 1.0  # decoding errors in the last second of a recovered file (a cut off last frame) are allowed
+_recovery_settle_time = 2.0  # a file which still grows within this time is still written by an FFmpeg process
+_recorded_tracks_max = 10000  # how many recorded track ids are remembered to detect looping
+_memory_report_interval = 3600.0  # seconds
+_gapless_filename_pattern = "{artist} - {album}"
+_gapless_recording_time_before_first_song = 1.0  # FFmpeg has to capture already when the first song starts
 
 # Variables that change during runtime
 is_script_paused = False
 is_first_playing = True
 pa_spotify_sink_input_id = -1
 internal_track_counter = 1
-recorded_tracks = {}
+recorded_tracks = OrderedDict()  # trackid -> None, oldest first
+recorded_tracks_lock = Lock()
 is_shutting_down = False
+gapless_recording = None
+exit_lock = threading.RLock()
 
 
 def main():
+    startup_timer = StartupTimer()
+
     handle_command_line()
+    startup_timer.phase("command line")
 
     if not _skip_intro:
         print(app_name + " v" + app_version)
         print("You should not pause, seek or change volume during recording!")
-        print("Existing files will be overridden!")
+        if _collision_policy == "overwrite":
+            print("Existing files will be overridden!")
         print("Use --help as argument to see all options.")
         print()
         print("Disclaimer:")
@@ -88,24 +109,60 @@ def main():
     # Create the output directory
     Path(_output_directory).mkdir(
         parents=True, exist_ok=True)
+    startup_timer.phase("output directory")
+
+    # Finalize or clean up recordings left behind by a previous run
+    # (runs in the background, the timer logs when it is done)
+    Journal.recover_async(startup_timer)
+
+    # Index the existing files in the background, it is needed when the first recording starts
+    OutputIndex.build_async(startup_timer)
+
+    # Load PulseAudio sink in the background while connecting to Spotify
+    load_sink_thread = PulseAudio.load_sink_async()
 
     # Init Spotify DBus listener
     global _spotify
-    _spotify = Spotify()
-
-    # Load PulseAudio sink
-    PulseAudio.load_sink()
+    try:
+        _spotify = Spotify()
+    except BaseException:
+        # Do not leave the sink behind if Spotify is not running (or anything else failed)
+        load_sink_thread.join()
+        if load_sink_thread.error is None:
+            PulseAudio.unload_sink()
+        raise
+    startup_timer.phase("Spotify DBus connection")
+
+    load_sink_thread.join()
+    if load_sink_thread.error is not None:
+        raise load_sink_thread.error
+    startup_timer.phase("PulseAudio sink")
 
     _spotify.init_pa_stuff_if_needed()
+    startup_timer.phase("PulseAudio setup")
+
+    startup_timer.report()
 
     # Keep the main thread alive (to be able to handle KeyboardInterrupt)
+    last_memory_report = time.monotonic()
     while True:
         time.sleep(1)
 
+        if time.monotonic() - last_memory_report >= _memory_report_interval:
+            last_memory_report = time.monotonic()
+            log_memory_report()
+
 
 def doExit():
+    # doExit() may be called from several threads at once, the first one exits the process
+    exit_lock.acquire()
+
     log.info(f"[{app_name}] Shutting down ...")
 
+    # Finish a gapless recording properly, it contains everything played so far
+    if gapless_recording is not None:
+        gapless_recording.finish()
+
     global is_shutting_down
     is_shutting_down = True
 
@@ -134,6 +191,8 @@ def handle_command_line():
     global _underscored_filenames
     global _use_internal_track_counter
     global _add_cover_art
+    global _gapless
+    global _collision_policy
 
     parser = argparse.ArgumentParser(
         description=app_name + " v" + app_version, formatter_class=argparse.RawTextHelpFormatter)
@@ -156,6 +215,17 @@ def handle_command_line():
                         action="store_true", default=_use_internal_track_counter)
     parser.add_argument("-a", "--add-cover-art", help="Embed the cover art from Spotify into the file",
                         action="store_true", default=_add_cover_art)
+    parser.add_argument("-g", "--gapless", help="Record the whole album or playlist into one file with a cue sheet\n"
+                                                "Start " + app_name + " first and then play the first track\n"
+                                                "Pausing Spotify ends the recording",
+                        action="store_true", default=_gapless)
+    parser.add_argument("-x", "--on-collision", help="What to do if a recording would replace an existing file\n"
+                                                     "overwrite: replace the existing file\n"
+                                                     "skip: do not record the track\n"
+                                                     "suffix: add a number to the new file name\n"
+                                                     "longer: only replace the existing file if the new one is longer\n"
+                                                     "Default: " + _collision_policy,
+                        choices=["overwrite", "skip", "suffix", "longer"], default=_collision_policy)
 
     args = parser.parse_args()
 
@@ -175,6 +245,10 @@ def handle_command_line():
 
     _add_cover_art = args.add_cover_art
 
+    _gapless = args.gapless
+
+    _collision_policy = args.on_collision
+
 
 def init_log():
     global log
@@ -192,12 +266,68 @@ def init_log():
     log.debug("Logger initialized")
 
 
+def log_memory_report():
+    try:
+        with open("/proc/self/statm") as fd:
+            rss = int(fd.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        import resource
+        # Peak instead of current size, in KiB on Linux
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    log.info(f"[{app_name}] Memory: {rss / 1024 / 1024:.1f} MiB resident, "
+             f"{len(recorded_tracks)} recorded track ids, {len(FFmpeg.instances)} FFmpeg instances, "
+             f"{threading.active_count()} threads")
+
+
+def add_recorded_track(track_id):
+    # Remember a recorded track to recognize Spotify looping over it.
+    # Only the newest ids are kept, looping always repeats a recent track.
+    with recorded_tracks_lock:
+        track_id = str(track_id)
+        recorded_tracks[track_id] = None
+        recorded_tracks.move_to_end(track_id)
+        while len(recorded_tracks) > _recorded_tracks_max:
+            recorded_tracks.popitem(last=False)
+
+
+class StartupTimer:
+    def __init__(self):
+        self.start_time = time.monotonic()
+        self.last_time = self.start_time
+        self.phases = []
+
+    def phase(self, name):
+        # Store the duration of the phase which just ended (logging may not be initialized yet)
+        now = time.monotonic()
+        self.phases.append((name, now - self.last_time))
+        self.last_time = now
+
+    def report(self):
+        for name, duration in self.phases:
+            log.debug(f"[{app_name}] Startup phase \"{name}\" took {duration:.3f}s")
+        log.info(f"[{app_name}] Ready to record after {self.last_time - self.start_time:.3f}s")
+
+    def background_finished(self, name):
+        # Called from the thread of a background startup task
+        log.debug(
+            f"[{app_name}] Background startup task \"{name}\" finished {time.monotonic() - self.start_time:.3f}s after launch")
+
+
 class Spotify:
     dbus_dest = "org.mpris.MediaPlayer2.spotify"
     dbus_path = "/org/mpris/MediaPlayer2"
     mpris_player_string = "org.mpris.MediaPlayer2.Player"
 
     def __init__(self):
+        # Import DBus and GLib only now, they are slow to load
+        global dbus
+        global GLib
+        import dbus
+        import dbus.mainloop.glib
+        from dbus.exceptions import DBusException
+        from gi.repository import GLib
+
         self.glibloop = None
 
         dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
@@ -219,7 +349,10 @@ class Spotify:
             pass
 
         self.track = self.get_track()
-        self.trackid = self.metadata.get(dbus.String(u'mpris:trackid'))
+        self.trackid = str(self.metadata.get(dbus.String(u'mpris:trackid')))
+        self.detect_ad()
+        self.track_changed_time = time.time()
+        self.gapless_start_thread = None
         self.playbackstatus = self.iface.Get(
             self.mpris_player_string, "PlaybackStatus")
 
@@ -265,14 +398,16 @@ class Spotify:
             "track": self.metadata_trackNumber.lstrip("0"),
             "title": self.metadata_title,
             "cover_url": self.metadata_artUrl,
+            "length": self.metadata_length,
         }
 
-    def get_track(self):
-        if _underscored_filenames:
-            filename_pattern = re.sub(" - ", "__", _filename_pattern)
-        else:
+    def get_track(self, filename_pattern=None):
+        if filename_pattern is None:
             filename_pattern = _filename_pattern
 
+        if _underscored_filenames:
+            filename_pattern = re.sub(" - ", "__", filename_pattern)
+
         ret = str(filename_pattern.format(
             artist=self.metadata_artist.replace("/", "_"),
             album=self.metadata_album.replace("/", "_"),
@@ -303,7 +438,6 @@ class Spotify:
 
             def run(self):
                 global is_script_paused
-                global recorded_tracks
                 global _output_directory
 
                 # Save current trackid to check later if it is still the same song playing (to avoid a bug when user skipped a song)
@@ -321,8 +455,8 @@ class Spotify:
                     return
 
                 # Check if Spotify started looping over a song
-                log.debug(recorded_tracks)
-                if self.parent.trackid in recorded_tracks.keys():
+                log.debug(f"[{app_name}] {len(recorded_tracks)} recorded track ids remembered")
+                if self.parent.trackid in recorded_tracks:
                     global internal_track_counter
 
                     internal_track_counter -= 1
@@ -351,6 +485,19 @@ class Spotify:
                     log.info(f"[{app_name}] Skipping ad")
                     return
 
+                # Handle tracks which would end up in an existing file
+                track = OutputIndex.resolve_track(self.parent.track)
+                if track is None:
+                    log.info(
+                        f"[{app_name}] Skipping already recorded {self.parent.track}")
+                    return
+
+                # Resolving may have asked the filesystem (while the output index is built), check again if the same song is still playing
+                if self.trackid_when_thread_started != self.parent.trackid or not self.parent.is_playing():
+                    OutputIndex.release(os.path.join(
+                        _output_directory, track) + ".flac")
+                    return
+
                 log.info(f"[{app_name}] Starting recording")
 
                 # Set is_script_paused to not trigger wrong Pause event in playbackstatus_changed()
@@ -361,9 +508,8 @@ class Spotify:
                 # Create output folder if necessary
                 # If filename_pattern specifies subfolder(s) the track name is only the basename while the dirname is the subfolder path
                 self.out_dir = os.path.join(
-                    _output_directory, os.path.dirname(self.parent.track))
-                Path(self.out_dir).mkdir(
-                    parents=True, exist_ok=True)
+                    _output_directory, os.path.dirname(track))
+                OutputIndex.ensure_dir(self.out_dir)
 
                 # Go to beginning of the song
                 is_script_paused = False
@@ -372,7 +518,7 @@ class Spotify:
                 # Start FFmpeg recording
                 ff = FFmpeg()
                 ff.record(self.parent.trackid, self.parent.track, time.time(), self.out_dir,
-                          self.parent.track, self.parent.get_metadata_for_ffmpeg())
+                          track, self.parent.get_metadata_for_ffmpeg())
 
                 # Give FFmpeg some time to start up before starting the song
                 time.sleep(_recording_time_before_song)
@@ -388,16 +534,14 @@ class Spotify:
         for i in range(len(instances)):
             class OverheadRecordingStopThread(Thread):
                 def run(self):
-                    global recorded_tracks
-
                     # Save recorded track ids to recognize spotify looping over a song
                     # only save if recording is longer than [recording_minimum_time] seconds
                     start_time = instances[i].start_time
                     stop_time = time.time()
                     duration = stop_time - start_time
                     if duration >= _recording_minimum_time:
-                        recorded_tracks[f"{instances[i].track_id}"] = instances[i].track_title
-                        log.info(f"[{app_name}] recording finished: \"{track_title}\"")
+                        add_recorded_track(instances[i].track_id)
+                        log.info(f"[{app_name}] recording finished: \"{instances[i].track_title}\"")
 
                     # Record a little longer to not miss something
                     time.sleep(_recording_time_after_song)
@@ -410,16 +554,20 @@ class Spotify:
 
     # This gets called whenever Spotify sends the playingUriChanged signal
     def on_playing_uri_changed(self, Player, three, four):
+        # Remember when the signal arrived (gapless mode uses it for the track index)
+        signal_time = time.time()
+
         # Pull updated metadata from Spotify
         self.pull_metadata()
 
         # Update track & trackid
-        new_trackid = self.metadata.get(dbus.String(u'mpris:trackid'))
+        new_trackid = str(self.metadata.get(dbus.String(u'mpris:trackid')))
         if self.trackid != new_trackid:
             # Update internal track metadata vars
             self.update_metadata()
             # Update trackid
             self.trackid = new_trackid
+            self.track_changed_time = signal_time
             # Update Ad detection
             self.detect_ad()
             # Update track name
@@ -427,7 +575,7 @@ class Spotify:
             # Trigger event method
             self.playing_song_changed()
             # Update internal track counter, do not count ads and already recorded tracks
-            if _use_internal_track_counter and not self.is_ad and new_trackid not in recorded_tracks.keys():
+            if _use_internal_track_counter and not self.is_ad and new_trackid not in recorded_tracks:
                 global internal_track_counter
                 internal_track_counter += 1
 
@@ -440,13 +588,80 @@ class Spotify:
     def playing_song_changed(self):
         log.info("[Spotify] Song changed: " + self.track)
 
-        self.start_record()
+        if _gapless:
+            if self.is_playing():
+                self.start_or_continue_gapless_recording()
+        else:
+            self.start_record()
 
     def playbackstatus_changed(self):
         log.info("[Spotify] State changed: " + self.playbackstatus)
 
         self.init_pa_stuff_if_needed()
 
+        if _gapless:
+            if self.is_playing():
+                if gapless_recording is None:
+                    self.start_or_continue_gapless_recording()
+            elif gapless_recording is not None and gapless_recording.started:
+                log.info(
+                    f"[{app_name}] Spotify is paused. Maybe the current album or playlist has ended.")
+                doExit()
+
+    def start_or_continue_gapless_recording(self):
+        if gapless_recording is not None:
+            # Check if Spotify started looping over the album or playlist
+            if not gapless_recording.add_track(self):
+                log.info(
+                    f"[{app_name}] Spotify has started looping over the album or playlist.")
+                gapless_recording.end_time = self.track_changed_time
+                doExit()
+            return
+
+        # Already starting
+        if self.gapless_start_thread is not None:
+            return
+
+        # Start the recording in a new Thread, to not block the DBus listener (resolving the name may ask the filesystem, starting waits for the song)
+        class GaplessStartThread(Thread):
+            def __init__(self, parent, *args):
+                Thread.__init__(self)
+                self.parent = parent
+
+            def run(self):
+                global gapless_recording
+
+                name = OutputIndex.resolve_track(
+                    self.parent.get_track(_gapless_filename_pattern), (".flac", ".cue"))
+                if name is None:
+                    log.info(f"[{app_name}] Skipping already recorded album")
+                    doExit()
+
+                # Let the song play for some seconds, "Previous" only seeks to the beginning after that
+                while True:
+                    trackid = self.parent.trackid
+                    time.sleep(_playback_time_before_seeking_to_beginning)
+                    if trackid == self.parent.trackid and self.parent.is_playing():
+                        break
+
+                # Spotify has to play into the recording sink before the recording starts
+                PulseAudio.init_spotify_sink_input_id()
+                PulseAudio.move_spotify_to_own_sink().join()
+
+                # Pause, start FFmpeg and play the song again from the beginning (only once, for the first song)
+                self.parent.send_dbus_cmd("Pause")
+                gapless_recording = GaplessRecording(self.parent, name)
+                time.sleep(_gapless_recording_time_before_first_song)
+                self.parent.send_dbus_cmd("Previous")
+                self.parent.send_dbus_cmd("Play")
+                play_time = time.time()
+
+                gapless_recording.started = True
+                gapless_recording.add_track(self.parent, play_time)
+
+        self.gapless_start_thread = GaplessStartThread(self)
+        self.gapless_start_thread.start()
+
     def pull_metadata(self):
         self.metadata = self.iface.Get(self.mpris_player_string, "Metadata")
 
@@ -464,6 +679,10 @@ class Spotify:
             "https://i.scdn.co/image/"
         )
 
+        # Track length in seconds (Spotify reports microseconds)
+        self.metadata_length = int(self.metadata.get(
+            dbus.String(u'mpris:length'), 0)) / 1000000
+
         if _use_internal_track_counter:
             global internal_track_counter
             self.metadata_trackNumber = str(internal_track_counter).zfill(3)
@@ -481,9 +700,122 @@ class Spotify:
                 PulseAudio.move_spotify_to_own_sink()
 
 
+class GaplessRecording:
+    # Records a whole album or playlist into one file, track changes go into a cue sheet
+
+    def __init__(self, spotify, name):
+        self.finished = False
+        self.lock = Lock()
+        self.started = False  # True once the first song plays from the beginning
+        self.tracks = []  # (start time, metadata)
+        self.trackids = set()  # to recognize Spotify looping over the album or playlist
+        self.end_time = None  # cut the recording here if set
+
+        out_dir = os.path.join(_output_directory, os.path.dirname(name))
+        OutputIndex.ensure_dir(out_dir)
+
+        log.info(f"[{app_name}] Starting gapless recording: {name}")
+
+        self.ffmpeg = FFmpeg()
+        self.ffmpeg.record(spotify.trackid, name, time.time(), out_dir, name, {
+            "artist": spotify.metadata_artist,
+            "album": spotify.metadata_album,
+            "cover_url": spotify.metadata_artUrl,
+        })
+
+    def add_track(self, spotify, start_time=None):
+        # Returns False if the track was already recorded (Spotify is looping)
+        if not self.started:
+            return True
+
+        # The ad is part of the recording anyway, but it gets no own track
+        if spotify.is_ad:
+            log.warning(f"[{app_name}] An ad is recorded into the gapless recording")
+            return True
+
+        if spotify.trackid in self.trackids:
+            return False
+        self.trackids.add(spotify.trackid)
+
+        if start_time is None:
+            start_time = spotify.track_changed_time
+        self.tracks.append((start_time, spotify.get_metadata_for_ffmpeg()))
+
+        log.info(
+            f"[{app_name}] Track {len(self.tracks)} at {self.format_index(start_time - self.ffmpeg.start_time)}: {spotify.track}")
+        return True
+
+    def finish(self):
+        # A second caller (e.g. Ctrl+C while handling the pause of Spotify) waits until the first one is done
+        with self.lock:
+            if self.finished:
+                return
+            self.finished = True
+
+            log.info(f"[{app_name}] Finishing gapless recording with {len(self.tracks)} track(s)")
+
+            # Cover art is added before returning, SpotRec exits right after this
+            new_file = self.ffmpeg.stop_blocking(wait_for_post_processing=True)
+            if new_file is None:
+                return
+
+            # FFmpeg needs some time until it really captures, the file is shorter than the time it ran by that much
+            latency = 0.0
+            duration = FFmpeg.probe_duration(new_file)
+            if duration is not None:
+                latency = max(0.0, self.ffmpeg.stop_time -
+                              self.ffmpeg.start_time - duration)
+            log.debug(f"[{app_name}] Gapless recording started capturing after {latency:.3f}s")
+
+            offsets = [(start_time - self.ffmpeg.start_time - latency, metadata)
+                       for start_time, metadata in self.tracks]
+            duration_limit = None
+            if self.end_time is not None:
+                duration_limit = self.end_time - self.ffmpeg.start_time - latency
+
+            cuesheet = self.build_cuesheet(os.path.basename(new_file), offsets)
+            self.ffmpeg.add_cuesheet(new_file, cuesheet, duration_limit)
+
+            # Write the cue sheet next to the recording as well
+            cue_file = new_file.rsplit('.flac', 1)[0] + ".cue"
+            with open(cue_file, "w", encoding="utf-8") as fd:
+                fd.write(cuesheet)
+            OutputIndex.add(cue_file)
+
+    @staticmethod
+    def build_cuesheet(filename, tracks):
+        def quote(value):
+            # Cue sheets have no escaping for quotes
+            return '"' + str(value).replace('"', "'") + '"'
+
+        first = tracks[0][1] if tracks else {}
+        lines = []
+        if "artist" in first:
+            lines.append("PERFORMER " + quote(first["artist"]))
+        if "album" in first:
+            lines.append("TITLE " + quote(first["album"]))
+        lines.append("FILE " + quote(filename) + " WAVE")
+        for number, (offset, metadata) in enumerate(tracks, 1):
+            lines.append(f"  TRACK {number:02d} AUDIO")
+            lines.append("    TITLE " + quote(metadata["title"]))
+            lines.append("    PERFORMER " + quote(metadata["artist"]))
+            lines.append("    INDEX 01 " + GaplessRecording.format_index(offset))
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def format_index(offset):
+        # mm:ss:ff with 75 frames per second
+        frames = int(round(max(0.0, offset) * 75))
+        return f"{frames // (60 * 75):02d}:{frames // 75 % 60:02d}:{frames % 75:02d}"
+
+
 class FFmpeg:
     instances = []
 
+    # Instances live as long as their recording, so keep them small
+    __slots__ = ("track_id", "track_title", "start_time", "out_dir", "pulse_input", "tmp_file_prefix",
+                 "filename", "cover_url", "length", "process", "pid", "stop_time")
+
     def record(self, track_id: str, track_title: str, start_time: float, out_dir: str, file: str, metadata_for_file={}):
         self.track_id = track_id
         self.track_title = track_title
@@ -498,7 +830,10 @@ class FFmpeg:
             os.path.basename(file) + ".flac"
 
         # save this to self because metadata_params is discarded after this function
-        self.cover_url = metadata_for_file.pop('cover_url')
+        # (only if it is needed later, to not keep the URL of every track)
+        cover_url = metadata_for_file.pop('cover_url')
+        self.cover_url = cover_url if _add_cover_art else None
+        self.length = metadata_for_file.pop('length', 0.0)
         # build metadata param
         metadata_params = ''
         for key, value in metadata_for_file.items():
@@ -522,15 +857,26 @@ class FFmpeg:
 
         self.instances.append(self)
 
+        # Remember the hidden file, so it can be recovered if SpotRec gets killed
+        Journal.begin(os.path.join(self.out_dir, self.filename),
+                      os.path.join(self.out_dir, self.filename[len(self.tmp_file_prefix):]), self.length)
+
         log.info(f"[FFmpeg] [{self.pid}] Recording started")
 
     # The blocking version of this method waits until the process is dead
-    def stop_blocking(self):
+    # Returns the finished file or None if there is none
+    def stop_blocking(self, wait_for_post_processing=False):
+        finished_file = None
+
         # Remove from instances list (and terminate)
         if self in self.instances:
             self.instances.remove(self)
 
+            new_file = os.path.join(self.out_dir,
+                                    self.filename[len(self.tmp_file_prefix):])
+
             # Send CTRL_C
+            self.stop_time = time.time()
             self.process.terminate()
 
             log.info(f"[FFmpeg] [{self.pid}] terminated")
@@ -549,14 +895,22 @@ class FFmpeg:
                 if not is_shutting_down:  # Do not post-process unfinished recordings
                     tmp_file = os.path.join(
                         self.out_dir, self.filename)
-                    new_file = os.path.join(self.out_dir,
-                                            self.filename[len(self.tmp_file_prefix):])
-                    if os.path.exists(tmp_file):
+                    if os.path.exists(tmp_file) and not OutputIndex.should_replace(tmp_file, new_file):
+                        os.remove(tmp_file)
+                        Journal.end(tmp_file)
+                        log.info(
+                            f"[FFmpeg] [{self.pid}] Kept the longer existing file instead of {self.filename}")
+                    elif os.path.exists(tmp_file):
                         shutil.move(tmp_file, new_file)
+                        Journal.end(tmp_file)
+                        OutputIndex.add(new_file)
                         log.debug(
                             f"[FFmpeg] [{self.pid}] Successfully renamed {self.filename}")
+                        finished_file = new_file
                         global _add_cover_art
-                        if _add_cover_art:
+                        if _add_cover_art and wait_for_post_processing:
+                            self.add_cover_art(new_file)
+                        elif _add_cover_art:
                             class AddCoverArtThread(Thread):
                                 def __init__(self, parent, fullfilepath):
                                     Thread.__init__(self)
@@ -571,12 +925,18 @@ class FFmpeg:
                                 self, new_file)
                             add_cover_art_thread.start()
                     else:
+                        Journal.end(tmp_file)
                         log.warning(
                             f"[FFmpeg] [{self.pid}] Failed renaming {self.filename}")
 
+            # The file name is not reserved anymore (if it was not finalized, it does not exist)
+            OutputIndex.release(new_file)
+
             # Remove process from memory (and don't left a ffmpeg 'zombie' process)
             self.process = None
 
+        return finished_file
+
     # Kill the process in the background
     def stop(self):
         class KillThread(Thread):
@@ -610,6 +970,7 @@ class FFmpeg:
             shutil.copy2(path, cover_file)
         else:
             log.debug(f'[FFmpeg] Cover art is on server for {fullfilepath}')
+            import requests
             answer = requests.get(self.cover_url)
             if not answer.ok:
                 log.debug(
@@ -620,6 +981,9 @@ class FFmpeg:
                 fd.write(answer.content)
         # add it to a temporary file
         log.debug(f'[FFmpeg] Merging cover art into {fullfilepath}')
+        # Journal the real duration, recovery must not accept a shorter copy
+        Journal.begin(temp_file, fullfilepath,
+                      FFmpeg.probe_duration(fullfilepath) or 0.0, replace=True)
         # no need for separate thread / logging here because quick
         returncode = Shell.run(_ffmpeg_executable + ' ' +
                                '-y -i {} -i {} -map 0:a -map 1 '.format(
@@ -631,13 +995,42 @@ class FFmpeg:
                                shlex.quote(temp_file)).returncode
         if returncode != 0:
             log.warning(f"[FFmpeg] Failed adding artwork to {fullfilepath}")
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+            Journal.end(temp_file)
             return
         # overwrite the actual file by the temp file
         log.debug(
             f'[FFmpeg] Added cover art for {fullfilepath} in temp file, moving it')
         shutil.move(temp_file, fullfilepath)
+        Journal.end(temp_file)
         os.remove(cover_file)   # now delete the cover art
 
+    # add the cue sheet as CUESHEET tag using a temp _withCuesheet file
+    # (optionally cut after duration_limit seconds)
+    # and then move it to replace the original file
+    def add_cuesheet(self, fullfilepath, cuesheet, duration_limit=None):
+        temp_file = fullfilepath.rsplit('.flac', 1)[0] + '_withCuesheet.flac'
+        log.debug(f'[FFmpeg] Adding cue sheet to {fullfilepath}')
+        # Journal the real duration (of the cut copy), recovery must not accept a shorter copy
+        length = FFmpeg.probe_duration(fullfilepath) or 0.0
+        if duration_limit is not None and length:
+            length = min(length, duration_limit)
+        Journal.begin(temp_file, fullfilepath, length, replace=True)
+        returncode = Shell.run(_ffmpeg_executable + ' ' +
+                               '-y -i {} -map 0 -codec copy '.format(shlex.quote(fullfilepath)) +
+                               ('-t {:.3f} '.format(duration_limit) if duration_limit is not None else '') +
+                               '-metadata CUESHEET=' + shlex.quote(cuesheet) + ' ' +
+                               shlex.quote(temp_file)).returncode
+        if returncode != 0:
+            log.warning(f"[FFmpeg] Failed adding cue sheet to {fullfilepath}")
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+            Journal.end(temp_file)
+            return
+        shutil.move(temp_file, fullfilepath)
+        Journal.end(temp_file)
+
     @staticmethod
     def killAll():
         log.info("[FFmpeg] Killing all instances")
@@ -648,6 +1041,354 @@ class FFmpeg:
 
         log.info("[FFmpeg] All instances killed")
 
+    @staticmethod
+    def probe_duration(file):
+        # Returns the duration in seconds or None if it could not be determined
+        # (needs a complete header, for files of killed recordings use repair() first)
+        try:
+            return float(Shell.check_output(_ffprobe_executable + ' -v error -show_entries format=duration '
+                                            '-of default=noprint_wrappers=1:nokey=1 ' + shlex.quote(file)))
+        except (subprocess.CalledProcessError, ValueError):
+            return None
+
+    @staticmethod
+    def repair(file, repaired_file):
+        # A killed FFmpeg leaves the STREAMINFO header without length and maybe a cut off last frame.
+        # Decoding and encoding again (lossless) drops broken frames and writes a complete header.
+        # This does not check the integrity, broken frames are only logged by FFmpeg.
+        return Shell.run(_ffmpeg_executable + ' -hide_banner -v error -y -i ' + shlex.quote(file) +
+                         ' -map 0 -codec copy -acodec flac -f flac ' + shlex.quote(repaired_file)).returncode == 0
+
+    @staticmethod
+    def check_integrity(file, duration):
+        # Decode the first 'duration' seconds, "-xerror" makes FFmpeg fail on the first broken frame
+        return Shell.run(_ffmpeg_executable + ' -hide_banner -v error -xerror -i ' + shlex.quote(file) +
+                         ' -t {:.3f} -f null -'.format(max(0.0, duration))).returncode == 0
+
+
+class Journal:
+    # Append-only log of the hidden temp files which are currently written.
+    # Every "begin" entry without a matching "end" entry is a leftover of a killed SpotRec.
+    lock = Lock()
+    fd = None  # kept open, the output directory may be on network storage
+    pending = {}  # tmp -> begin entry
+    writes_since_compaction = 0
+
+    @staticmethod
+    def path():
+        return os.path.join(_output_directory, _journal_filename)
+
+    @staticmethod
+    def begin(tmp_file: str, final_file: str, length: float = 0.0, replace: bool = False):
+        # replace: the temp file is a modified copy of final_file (not a new recording)
+        Journal.write({"op": "begin",
+                       "tmp": os.path.relpath(tmp_file, _output_directory),
+                       "final": os.path.relpath(final_file, _output_directory),
+                       "length": length,
+                       "replace": replace})
+
+    @staticmethod
+    def end(tmp_file: str):
+        Journal.write(
+            {"op": "end", "tmp": os.path.relpath(tmp_file, _output_directory)})
+
+    @staticmethod
+    def write(entry):
+        with Journal.lock:
+            if entry["op"] == "begin":
+                Journal.pending[entry["tmp"]] = entry
+            else:
+                Journal.pending.pop(entry["tmp"], None)
+            Journal.writes_since_compaction += 1
+
+            try:
+                if Journal.fd is None:
+                    Journal.fd = open(Journal.path(), "a", encoding="utf-8")
+
+                if not Journal.pending:
+                    # Nothing in flight, start over with an empty journal
+                    Journal.fd.truncate(0)
+                    Journal.writes_since_compaction = 0
+                elif Journal.writes_since_compaction >= _journal_compact_entries:
+                    Journal.compact()
+                else:
+                    Journal.fd.write(json.dumps(entry) + "\n")
+                # flush() is enough, the data only has to survive SpotRec being killed
+                Journal.fd.flush()
+            except OSError:
+                log.warning(f"[{app_name}] Failed writing the journal")
+
+    @staticmethod
+    def compact():
+        # Replace the journal with one which only contains the pending entries (Journal.lock must be held)
+        compact_file = Journal.path() + ".compact"
+        with open(compact_file, "w", encoding="utf-8") as fd:
+            for entry in Journal.pending.values():
+                fd.write(json.dumps(entry) + "\n")
+        Journal.fd.close()
+        Journal.fd = None
+        os.replace(compact_file, Journal.path())
+        Journal.fd = open(Journal.path(), "a", encoding="utf-8")
+        Journal.writes_since_compaction = 0
+
+    @staticmethod
+    def read_pending(journal_file):
+        pending = {}
+        with open(journal_file, encoding="utf-8") as fd:
+            for line in fd:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # The last line may be incomplete if SpotRec was killed while writing it
+                    continue
+                if entry["op"] == "begin":
+                    pending[entry["tmp"]] = entry
+                else:
+                    pending.pop(entry["tmp"], None)
+        return list(pending.values())
+
+    @staticmethod
+    def recover_async(startup_timer=None):
+        # Move the journal aside, so new recordings can start a fresh one while the old one is processed
+        journal_file = Journal.path()
+        recovering_file = journal_file + ".recovering"
+        if os.path.exists(journal_file):
+            if os.path.exists(recovering_file):
+                # A recovery was interrupted, merge it with the new journal
+                with open(journal_file, encoding="utf-8") as src, open(recovering_file, "a", encoding="utf-8") as dst:
+                    # Start on a new line in case the last entry was cut off
+                    dst.write("\n" + src.read())
+                os.remove(journal_file)
+            else:
+                os.replace(journal_file, recovering_file)
+        if not os.path.exists(recovering_file):
+            return
+
+        class RecoveryThread(Thread):
+            def run(self):
+                entries = Journal.read_pending(recovering_file)
+                if entries:
+                    log.info(
+                        f"[{app_name}] Recovering {len(entries)} unfinished file(s)")
+                    with ThreadPoolExecutor(max_workers=_recovery_workers) as executor:
+                        # list() to wait for all
+                        list(executor.map(Journal.recover, entries))
+                os.remove(recovering_file)
+
+                if startup_timer is not None:
+                    startup_timer.background_finished("crash recovery")
+
+        recovery_thread = RecoveryThread()
+        # Do not keep SpotRec from exiting, the ".recovering" journal is kept until it is done
+        recovery_thread.daemon = True
+        recovery_thread.start()
+
+    @staticmethod
+    def recover(entry):
+        # Errors are only logged, one bad entry should not stop the others
+        try:
+            Journal.recover_file(entry)
+        except Exception:
+            log.warning(
+                f"[{app_name}] Failed recovering {entry.get('tmp')}: {traceback.format_exc()}")
+
+    @staticmethod
+    def recover_file(entry):
+        tmp_file = os.path.join(_output_directory, entry["tmp"])
+        final_file = os.path.join(_output_directory, entry["final"])
+        repaired_file = os.path.join(os.path.dirname(
+            tmp_file), ".repair-" + os.path.basename(tmp_file))
+
+        # Left over if SpotRec was killed during the last recovery
+        if os.path.exists(repaired_file):
+            os.remove(repaired_file)
+
+        if not os.path.exists(tmp_file):
+            return
+
+        # The FFmpeg process of a killed SpotRec may still be running, do not touch the file then
+        size = os.path.getsize(tmp_file)
+        time.sleep(_recovery_settle_time)
+        if os.path.getsize(tmp_file) != size:
+            log.info(
+                f"[{app_name}] {entry['tmp']} is still written, trying again on the next start")
+            Journal.write(entry)
+            return
+
+        if entry.get("replace"):
+            # A modified copy (cover art, cue sheet) must not replace its complete original by a shorter file
+            minimum_duration = FFmpeg.probe_duration(final_file)
+            if minimum_duration is None:
+                minimum_duration = entry["length"] or _recording_minimum_time
+            elif entry["length"]:
+                # The copy may be cut on purpose (gapless recording ending with a loop)
+                minimum_duration = min(minimum_duration, entry["length"])
+        elif entry["length"]:
+            # Only keep complete recordings (FFmpeg starts before the song)
+            minimum_duration = entry["length"] + _recording_time_before_song
+        else:
+            minimum_duration = _recording_minimum_time
+
+        duration = None
+        if FFmpeg.repair(tmp_file, repaired_file):
+            duration = FFmpeg.probe_duration(repaired_file)
+
+        keep = duration is not None and duration >= minimum_duration and \
+            FFmpeg.check_integrity(tmp_file, duration - _recovery_tail_allowance)
+        if not keep:
+            log.info(f"[{app_name}] Removed unfinished {entry['tmp']}")
+        elif not entry.get("replace"):
+            # A new recording, it must not simply replace an existing file
+            track = OutputIndex.resolve_track(
+                os.path.relpath(final_file, _output_directory).rsplit('.flac', 1)[0])
+            if track is None:
+                keep = False
+            else:
+                final_file = os.path.join(_output_directory, track) + ".flac"
+                if not OutputIndex.should_replace(repaired_file, final_file):
+                    OutputIndex.release(final_file)
+                    keep = False
+            if not keep:
+                log.info(
+                    f"[{app_name}] Removed recovered {entry['tmp']}, {entry['final']} already exists")
+
+        if keep:
+            shutil.move(repaired_file, final_file)
+            os.remove(tmp_file)
+            OutputIndex.add(final_file)
+            log.info(
+                f"[{app_name}] Recovered {os.path.relpath(final_file, _output_directory)}")
+        else:
+            if os.path.exists(repaired_file):
+                os.remove(repaired_file)
+            os.remove(tmp_file)
+        OutputIndex.discard(tmp_file)
+
+
+class OutputIndex:
+    # In-memory copy of the output directory tree, so existence checks and creating
+    # directories need no filesystem access. Built once at startup, updated as files are finalized.
+    # Until it is built, the filesystem is asked directly and the answers are added to the index.
+    files = {}  # directory relative to the output directory -> set of file names
+    reserved = set()  # files which are currently recorded (relative to the output directory)
+    lock = Lock()
+    ready = threading.Event()
+
+    @staticmethod
+    def build_async(startup_timer=None):
+        class BuildIndexThread(Thread):
+            def run(self):
+                start_time = time.monotonic()
+                files = {}
+                count = 0
+                for root, dirnames, filenames in os.walk(_output_directory):
+                    files[os.path.relpath(root, _output_directory)] = set(filenames)
+                    count += len(filenames)
+
+                with OutputIndex.lock:
+                    # Keep what was added while walking
+                    for directory, filenames in files.items():
+                        OutputIndex.files.setdefault(
+                            directory, set()).update(filenames)
+                OutputIndex.ready.set()
+
+                log.debug(
+                    f"[{app_name}] Indexed {count} files in {len(files)} directories in {time.monotonic() - start_time:.3f}s")
+                if startup_timer is not None:
+                    startup_timer.background_finished("output index")
+
+        build_index_thread = BuildIndexThread()
+        # Do not keep SpotRec from exiting if the start fails
+        build_index_thread.daemon = True
+        build_index_thread.start()
+
+    @staticmethod
+    def relative(path):
+        return os.path.relpath(os.path.normpath(path), _output_directory)
+
+    @staticmethod
+    def exists(file, include_reserved=True):
+        with OutputIndex.lock:
+            return OutputIndex.exists_locked(OutputIndex.relative(file), include_reserved)
+
+    @staticmethod
+    def exists_locked(file, include_reserved=True):
+        # Like exists(), for a relative path (OutputIndex.lock must be held)
+        if include_reserved and file in OutputIndex.reserved:
+            return True
+        directory, filename = os.path.split(file)
+        if filename in OutputIndex.files.get(directory or ".", ()):
+            return True
+        if not OutputIndex.ready.is_set() and os.path.exists(os.path.join(_output_directory, file)):
+            OutputIndex.files.setdefault(directory or ".", set()).add(filename)
+            return True
+        return False
+
+    @staticmethod
+    def add(file):
+        file = OutputIndex.relative(file)
+        directory, filename = os.path.split(file)
+        with OutputIndex.lock:
+            OutputIndex.files.setdefault(directory or ".", set()).add(filename)
+            OutputIndex.reserved.discard(file)
+
+    @staticmethod
+    def discard(file):
+        directory, filename = os.path.split(OutputIndex.relative(file))
+        with OutputIndex.lock:
+            OutputIndex.files.get(directory or ".", set()).discard(filename)
+
+    @staticmethod
+    def release(file):
+        with OutputIndex.lock:
+            OutputIndex.reserved.discard(OutputIndex.relative(file))
+
+    @staticmethod
+    def ensure_dir(directory):
+        directory = OutputIndex.relative(directory)
+        with OutputIndex.lock:
+            if directory in OutputIndex.files:
+                return
+        Path(os.path.join(_output_directory, directory)).mkdir(
+            parents=True, exist_ok=True)
+        with OutputIndex.lock:
+            # Remember the parents as well
+            while directory and directory not in OutputIndex.files:
+                OutputIndex.files[directory] = set()
+                directory = os.path.dirname(directory)
+
+    @staticmethod
+    def resolve_track(track, extensions=(".flac",)):
+        # Returns the track name to record to (without extension) or None if the track should be skipped
+        # All files with the given extensions (e.g. the recording and its cue sheet) are checked for collisions
+        def collides(track):
+            return any(OutputIndex.exists_locked(os.path.normpath(track) + extension) for extension in extensions)
+
+        # Check and reserve at once, so two threads can not get the same name
+        with OutputIndex.lock:
+            if collides(track):
+                if _collision_policy == "skip":
+                    return None
+                if _collision_policy == "suffix":
+                    number = 2
+                    while collides(f"{track} ({number})"):
+                        number += 1
+                    track = f"{track} ({number})"
+
+            OutputIndex.reserved.add(os.path.normpath(track) + ".flac")
+        return track
+
+    @staticmethod
+    def should_replace(new_file, existing_file):
+        if _collision_policy != "longer" or not OutputIndex.exists(existing_file, include_reserved=False):
+            return True
+
+        existing_duration = FFmpeg.probe_duration(existing_file)
+        if existing_duration is None:
+            return True
+        new_duration = FFmpeg.probe_duration(new_file)
+        return new_duration is not None and new_duration > existing_duration
+
 
 class Shell:
     @staticmethod
@@ -697,6 +1438,24 @@ class PulseAudio:
             # To use another master sink where to play:
             # pactl load-module module-remap-sink sink_name=spotrec sink_properties=device.description="spotrec" master=MASTER_SINK_NAME channels=2 remix=no
 
+    @staticmethod
+    def load_sink_async():
+        # Load the sink in a new Thread, join() it and check 'error' before using the sink
+        class LoadSinkThread(Thread):
+            def __init__(self, *args):
+                Thread.__init__(self)
+                self.error = None
+
+            def run(self):
+                try:
+                    PulseAudio.load_sink()
+                except Exception as e:
+                    self.error = e
+
+        load_sink_thread = LoadSinkThread()
+        load_sink_thread.start()
+        return load_sink_thread
+
     @staticmethod
     def unload_sink():
         log.info(f"[{app_name}] Unloading pulse sink")
@@ -742,6 +1501,7 @@ class PulseAudio:
 
         move_spotify_to_sink_thread = MoveSpotifyToSinktThread()
         move_spotify_to_sink_thread.start()
+        return move_spotify_to_sink_thread
 
     @staticmethod
     def set_sink_volumes_to_100():